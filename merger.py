@@ -3,10 +3,20 @@ Core CSV merging functionality.
 Handles reading, processing, and merging CSV files by class.
 """
 
+import hashlib
+import io
+import json
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
-from utils import natural_sort_files, find_matching_column, extract_ex_number
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from utils import sort_files_with_ex_numbers, classify_columns, make_temp_file
 from logger import Logger
 
 
@@ -45,12 +55,12 @@ class CSVMerger:
         Returns:
             List of Path objects for each class folder
         """
-        # Use list comprehension to filter directories
-        # Path.iterdir() gives all items in the directory
-        # We filter to keep only directories (not files)
-        return [item for item in self.root_path.iterdir() if item.is_dir()]
+        # os.scandir() returns DirEntry objects that cache the file type
+        # from the directory listing, so is_dir() usually needs no extra stat call
+        with os.scandir(self.root_path) as entries:
+            return [Path(entry.path) for entry in entries if entry.is_dir()]
     
-    def get_csv_files(self, class_folder: Path) -> List[Path]:
+    def get_csv_files(self, class_folder: Path) -> List[Tuple[Path, Optional[int]]]:
         """
         Get all CSV files in a class folder, naturally sorted.
         
@@ -58,33 +68,146 @@ class CSVMerger:
             class_folder: Path to the class folder
             
         Returns:
-            Sorted list of CSV file paths
+            Sorted list of (CSV file path, Ex number or None) tuples
         """
-        # glob('*.csv') finds all files ending with .csv
-        csv_files = list(class_folder.glob('*.csv'))
-        return natural_sort_files(csv_files)
+        # Single directory scan; the name check runs before the (cached) type check
+        with os.scandir(class_folder) as entries:
+            csv_files = [Path(entry.path) for entry in entries
+                         if entry.name.endswith('.csv') and entry.is_file()]
+        return sort_files_with_ex_numbers(csv_files)
     
     def read_csv_safely(self, file_path: Path) -> Tuple[pd.DataFrame, bool]:
         """
         Read a CSV file with error handling.
         
+        Every column is read, since the vertical merge writes them all out.
+        The time (channel) column is declared as float64 and the X/Y/Z
+        readings as float32; other columns keep their inferred types.
+        
+        The parsed data is cached next to the CSV as an uncompressed Feather
+        (Arrow IPC) file. Later runs memory-map the cache instead of parsing
+        the CSV again, as long as the CSV's size and modification time still
+        match the ones recorded in the cache, along with the read options
+        (column dtypes) it was parsed with. An unreadable cache is ignored.
+        
         Args:
             file_path: Path to the CSV file
             
         Returns:
             Tuple of (DataFrame, success_flag)
         """
+        # A dedicated suffix, so the cache never replaces an unrelated file
+        cache_path = file_path.with_name(file_path.name + '.mergecache.feather')
+        
         try:
-            # Read CSV with maximum precision
-            # float_precision='high' prevents rounding errors
-            df = pd.read_csv(file_path, float_precision='high')
-            return df, True
+            # Peek at the header to find the time and X/Y/Z columns
+            header = pd.read_csv(file_path, nrows=0).columns
+            columns = classify_columns(header)
+            
+            # Declare dtypes only for the identified time and X/Y/Z columns.
+            # X/Y/Z sensor readings don't need double precision; float32 halves
+            # their memory and write cost. Time stays float64 so long
+            # recordings keep their sample resolution
+            dtype = {col: 'float32' for axis in ('x', 'y', 'z') for col in columns[axis]}
+            if columns['time']:
+                dtype[columns['time'][0]] = 'float64'
+            read_options = {'engine': 'pyarrow', 'dtype': dtype}
+            
+            # Identify the exact CSV and read options the cache was built from.
+            # A copied-over file can have an older mtime, so only an exact
+            # match counts; a change to the typing rules invalidates it too
+            stat = file_path.stat()
+            options_hash = hashlib.sha256(
+                json.dumps(read_options, sort_keys=True).encode()).hexdigest()
+            source_key = {b'source_size': str(stat.st_size).encode(),
+                          b'source_mtime_ns': str(stat.st_mtime_ns).encode(),
+                          b'read_options': options_hash.encode()}
+            
+            if cache_path.exists():
+                try:
+                    table = feather.read_table(cache_path, memory_map=True)
+                    cache_key = table.schema.metadata or {}
+                    if all(cache_key.get(k) == v for k, v in source_key.items()):
+                        return table.to_pandas(), True
+                except Exception as e:
+                    print(f"  ⚠️  Ignoring unreadable cache for {file_path.name}: {e}")
+            
+            try:
+                # Read CSV with the multi-threaded PyArrow parser
+                # With the dtypes declared up front, type inference is
+                # skipped for those columns
+                df = pd.read_csv(file_path, **read_options)
+            except ValueError:
+                # A column that looks like time/X/Y/Z isn't numeric after all;
+                # read again and let the parser infer the types
+                df = pd.read_csv(file_path, engine='pyarrow')
         except Exception as e:
             print(f"  ⚠️  Error reading {file_path.name}: {e}")
             return pd.DataFrame(), False
+        
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), **source_key})
+            
+            # Write to a temporary file and move it into place, so an
+            # interrupted run never leaves a half-written cache behind.
+            # Uncompressed, so the next run can map it without decoding
+            tmp_file = make_temp_file(cache_path.parent)
+            try:
+                feather.write_feather(table, str(tmp_file), compression='uncompressed')
+                os.replace(tmp_file, cache_path)
+            except BaseException:
+                tmp_file.unlink()
+                raise
+        except Exception as e:
+            print(f"  ⚠️  Could not cache {file_path.name}: {e}")
+        
+        return df, True
     
-    def merge_dataframes(self, dfs: List[pd.DataFrame], 
-                        file_names: List[str]) -> pd.DataFrame:
+    def read_dataframes(self, csv_files: List[Tuple[Path, Optional[int]]],
+                        file_records: List[Dict]
+                        ) -> Iterator[Tuple[str, Optional[int], pd.DataFrame]]:
+        """
+        Read CSV files one after another, skipping unreadable ones.
+        
+        The next file is read on a background thread while the current one
+        is being processed, so at most two files are held in memory.
+        
+        Args:
+            csv_files: Sorted list of (CSV file path, Ex number) tuples
+            file_records: List that receives a metadata entry for each file read
+            
+        Yields:
+            Tuples of (file name, Ex number, DataFrame) in the original order
+        """
+        if not csv_files:
+            return
+        
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.read_csv_safely, csv_files[0][0])
+            
+            for idx, (csv_file, ex_num) in enumerate(csv_files):
+                df, success = pending.result()
+                
+                # Start reading the next file before handing this one out
+                if idx + 1 < len(csv_files):
+                    pending = executor.submit(self.read_csv_safely, csv_files[idx + 1][0])
+                
+                if success:
+                    file_records.append({
+                        'name': csv_file.name,
+                        'ex_number': ex_num,
+                        'rows': len(df),
+                        'columns': len(df.columns)
+                    })
+                    yield csv_file.name, ex_num, df
+                
+                # Drop this reference so the frame is freed as soon as the
+                # caller is done with it, not when the next result arrives
+                del df
+    
+    def merge_dataframes(self, frames: Iterable[Tuple[str, Optional[int], pd.DataFrame]]
+                         ) -> Iterator[Dict[str, np.ndarray]]:
         """
         Merge multiple DataFrames vertically (row-wise) with continuous time.
         
@@ -92,96 +215,156 @@ class CSVMerger:
         value from the accumulated data PLUS the sampling interval, making the 
         time column continuous without overlapping timestamps.
         
+        The merge is streamed: every DataFrame is yielded as a block of NumPy
+        column arrays (in the column order of the first DataFrame) as soon as
+        its time is shifted, so it can be written out before the next is read.
+        
         Args:
-            dfs: List of DataFrames to merge
-            file_names: List of original file names (for labeling)
+            frames: Iterable of (file name, Ex number, DataFrame) tuples in merge order
             
-        Returns:
-            Merged DataFrame with continuous time
+        Yields:
+            Dictionaries mapping column names to arrays, one per DataFrame
         """
-        if not dfs:
-            return pd.DataFrame()
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            return
         
         # Find the time column in the first DataFrame
-        first_df = dfs[0]
-        time_col = find_matching_column('channel', first_df.columns)
+        _, _, first_df = first
+        first_kinds = classify_columns(first_df.columns)
+        time_col = first_kinds['time'][0] if first_kinds['time'] else None
         
         if time_col is None:
             print("  ⚠️  Warning: No time/channel column found")
-            return pd.DataFrame()
+            return
         
         print(f"  🕒 Time column identified: '{time_col}'")
         
-        # Start with the first DataFrame
-        result = dfs[0].copy()
+        column_names = list(first_df.columns)
+        first_schema = tuple(column_names)
+        # NaN fill dtypes for columns a later file lacks; non-NumPy dtypes
+        # (e.g. pandas strings) are filled as object arrays
+        column_dtypes = {
+            col: first_df[col].dtype if isinstance(first_df[col].dtype, np.dtype) else object
+            for col in column_names
+        }
+        
+        # X/Y/Z columns that are unambiguous in the first file can be matched
+        # by kind in files that spell them differently (e.g. "x" vs "X")
+        axis_kinds = {cols[0]: axis for axis, cols in first_kinds.items()
+                      if axis != 'time' and len(cols) == 1}
+        
+        # Files with a different schema need their columns matched to the
+        # first file's; cache the matching per unique set of column names
+        column_map_cache = {}
+        
+        # The first DataFrame is emitted unchanged
+        block = {col: first_df[col].to_numpy() for col in column_names}
+        times = block[time_col]
         
         # Calculate sampling interval from the first DataFrame
         # This is the difference between the last two time values
-        if len(result) >= 2:
-            sampling_interval = result[time_col].iloc[-1] - result[time_col].iloc[-2]
+        if len(times) >= 2:
+            sampling_interval = times[-1] - times[-2]
         else:
             # If only one row, use a default or the time value itself
-            sampling_interval = result[time_col].iloc[-1] if len(result) == 1 else 0
+            sampling_interval = times[-1] if len(times) == 1 else 0
         
-        print(f"  📊 Ex1: {len(result)} rows, time range: {result[time_col].iloc[0]:.6f} to {result[time_col].iloc[-1]:.6f}, sampling interval: {sampling_interval:.6f}")
+        print(f"  📊 Ex1: {len(times)} rows, time range: {times[0]:.6f} to {times[-1]:.6f}, sampling interval: {sampling_interval:.6f}")
         
         # Current offset starts at last time + sampling interval
-        current_time_offset = result[time_col].iloc[-1] + sampling_interval
+        current_time_offset = times[-1] + sampling_interval
+        
+        yield block
+        
+        # Release the first file before the next one is read
+        del first, first_df, block, times
         
         # For each subsequent DataFrame
-        for idx, (df, file_name) in enumerate(zip(dfs[1:], file_names[1:]), start=2):
-            ex_num = extract_ex_number(file_name)
+        for idx, (file_name, ex_num, df) in enumerate(frames, start=2):
             ex_label = f"Ex{ex_num}" if ex_num else f"Ex{idx}"
             
-            # Create a copy to avoid modifying the original
-            df_copy = df.copy()
-            
-            # Find time column in this DataFrame (might have different case/spacing)
-            df_time_col = find_matching_column('channel', df_copy.columns)
-            
-            if df_time_col is None:
-                print(f"  ⚠️  Warning: No time column in {file_name}, skipping...")
-                continue
-            
-            # Get the first timestamp in this DataFrame
-            first_time_in_df = df_copy[df_time_col].iloc[0]
+            schema = tuple(df.columns)
+            if schema == first_schema:
+                # Fast path: files in a class almost always share the first
+                # file's schema, so the columns can be taken as they are
+                block = {col: df[col].to_numpy() for col in column_names}
+            else:
+                if schema not in column_map_cache:
+                    kinds = classify_columns(df.columns)
+                    
+                    # Find time column in this DataFrame (might have different case/spacing)
+                    if not kinds['time']:
+                        column_map_cache[schema] = None
+                    else:
+                        # Map each of the first file's columns to a column here:
+                        # time by kind, then same name, then X/Y/Z by kind
+                        source_cols = {time_col: kinds['time'][0]}
+                        for col in column_names:
+                            if col in source_cols:
+                                continue
+                            if col in df.columns:
+                                source_cols[col] = col
+                            elif col in axis_kinds and len(kinds[axis_kinds[col]]) == 1:
+                                source_cols[col] = kinds[axis_kinds[col]][0]
+                        
+                        used = set(source_cols.values())
+                        dropped = [col for col in df.columns if col not in used]
+                        column_map_cache[schema] = (source_cols, dropped)
+                
+                if column_map_cache[schema] is None:
+                    print(f"  ⚠️  Warning: No time column in {file_name}, skipping...")
+                    continue
+                
+                source_cols, dropped = column_map_cache[schema]
+                if dropped:
+                    print(f"  ⚠️  Warning: {file_name} has column(s) not in the first file, dropped: {dropped}")
+                
+                # Line the columns up with the first DataFrame;
+                # columns missing from this file are filled with NaN
+                block = {}
+                for col in column_names:
+                    if col in source_cols:
+                        block[col] = df[source_cols[col]].to_numpy()
+                    else:
+                        block[col] = np.full(len(df), np.nan, dtype=column_dtypes[col])
             
             # Add offset to make time continuous
             # The offset is: last_time_from_previous + sampling_interval
-            df_copy[df_time_col] = df_copy[df_time_col] - first_time_in_df + current_time_offset
+            # This builds a new array, so the DataFrame itself is untouched
+            times = block[time_col]
+            times = times - times[0] + current_time_offset
+            block[time_col] = times
             
             # Calculate sampling interval for this DataFrame
-            if len(df_copy) >= 2:
-                current_sampling_interval = df_copy[df_time_col].iloc[-1] - df_copy[df_time_col].iloc[-2]
+            if len(times) >= 2:
+                current_sampling_interval = times[-1] - times[-2]
             else:
                 current_sampling_interval = sampling_interval  # Use previous interval as fallback
             
-            print(f"  📊 {ex_label}: {len(df_copy)} rows, time range: {df_copy[df_time_col].iloc[0]:.6f} to {df_copy[df_time_col].iloc[-1]:.6f}, sampling interval: {current_sampling_interval:.6f}")
+            print(f"  📊 {ex_label}: {len(times)} rows, time range: {times[0]:.6f} to {times[-1]:.6f}, sampling interval: {current_sampling_interval:.6f}")
             
             # Update the offset for the next iteration
             # Add the last time value + sampling interval
-            current_time_offset = df_copy[df_time_col].iloc[-1] + current_sampling_interval
-            
-            # Rename columns if they differ from the result DataFrame
-            # This ensures column names match for concatenation
-            if df_time_col != time_col:
-                df_copy.rename(columns={df_time_col: time_col}, inplace=True)
+            current_time_offset = times[-1] + current_sampling_interval
             
-            # Append the DataFrame
-            result = pd.concat([result, df_copy], ignore_index=True)
-        
-        return result
+            yield block
+            del df, block, times
     
     def process_class(self, class_folder: Path, output_base_dir: Path) -> Dict:
         """
         Process all CSV files in a class folder.
         
+        The files are streamed: each one is read, time-shifted and appended
+        to the merged output CSV before the next is needed.
+        
         Args:
             class_folder: Path to the class folder
             output_base_dir: Base output directory
             
         Returns:
-            Dictionary containing metadata and merged DataFrame
+            Dictionary containing metadata about the merged output
         """
         class_name = class_folder.name
         print(f"\n{'='*60}")
@@ -192,16 +375,19 @@ class CSVMerger:
         
         if not csv_files:
             print(f"  ⚠️  No CSV files found in {class_name}")
-            return {'class': class_name, 'files': [], 'merged_df': pd.DataFrame(), 'output_folder': None}
+            return {'class': class_name, 'files': [], 'output_folder': None}
         
-        print(f"Found {len(csv_files)} CSV file(s):")
-        
-        dataframes = []
-        file_names = []
+        # Build the file listing first and print it in one call
+        lines = [f"Found {len(csv_files)} CSV file(s):"]
+        for csv_file, ex_num in csv_files:
+            ex_label = f"Ex{ex_num}" if ex_num else "Unknown"
+            lines.append(f"  📄 {ex_label}: {csv_file.name}")
+        print('\n'.join(lines))
         
         # Create output folder for this class
         class_output_folder = output_base_dir / class_name
         class_output_folder.mkdir(parents=True, exist_ok=True)
+        output_file = class_output_folder / f"{class_name}_merged.csv"
         
         metadata = {
             'class': class_name,
@@ -211,38 +397,52 @@ class CSVMerger:
             'output_folder': class_output_folder
         }
         
-        # Read each CSV file
-        for csv_file in csv_files:
-            ex_num = extract_ex_number(csv_file.name)
-            ex_label = f"Ex{ex_num}" if ex_num else "Unknown"
-            print(f"  📄 {ex_label}: {csv_file.name}")
-            
-            df, success = self.read_csv_safely(csv_file)
-            
-            if success:
-                dataframes.append(df)
-                file_names.append(csv_file.name)
+        print(f"\n  🔄 Merging {len(csv_files)} file(s) vertically...")
+        
+        # Append each merged block as soon as it is ready. The blocks go to a
+        # temporary file that only replaces the output once every file has
+        # been merged, so a failure never leaves a truncated CSV behind
+        frames = self.read_dataframes(csv_files, metadata['files'])
+        sink = None
+        tmp_file = None
+        try:
+            for block in self.merge_dataframes(frames):
+                # The column arrays are wrapped as an Arrow table without copying;
+                # from_pandas=True writes NaN as an empty cell, like DataFrame.to_csv
+                table = pa.table({col: pa.array(values, from_pandas=True)
+                                  for col, values in block.items()})
                 
-                metadata['files'].append({
-                    'name': csv_file.name,
-                    'ex_number': ex_num,
-                    'rows': len(df),
-                    'columns': len(df.columns)
-                })
-        
-        # Merge all DataFrames
-        if dataframes:
-            print(f"\n  🔄 Merging {len(dataframes)} file(s) vertically...")
-            merged_df = self.merge_dataframes(dataframes, file_names)
-            
-            metadata['total_rows'] = len(merged_df)
-            metadata['total_columns'] = len(merged_df.columns)
-            metadata['merged_df'] = merged_df
+                # Only the first block writes the header. Blocks are written
+                # separately, so a file whose column types differ from the first
+                # (e.g. text in a numeric column) is still written as-is.
+                # PyArrow's CSV writer runs in C++, far faster than DataFrame.to_csv
+                options = pacsv.WriteOptions(include_header=sink is None)
+                if sink is None:
+                    tmp_file = make_temp_file(class_output_folder)
+                    sink = pa.OSFile(str(tmp_file), 'wb')
+                pacsv.write_csv(table, sink, write_options=options)
+                
+                metadata['total_rows'] += table.num_rows
+                metadata['total_columns'] = table.num_columns
+                
+                # Written out, so free the block before the next file is merged
+                del block, table
             
-            print(f"  ✅ Merged DataFrame: {len(merged_df)} rows × {len(merged_df.columns)} columns")
-        else:
+            if sink is not None:
+                sink.close()
+                os.replace(tmp_file, output_file)
+        except BaseException:
+            if sink is not None:
+                sink.close()
+            if tmp_file is not None and tmp_file.exists():
+                tmp_file.unlink()
+            raise
+        
+        if sink is not None:
+            print(f"  ✅ Merged data: {metadata['total_rows']} rows × {metadata['total_columns']} columns")
+            print(f"  💾 Saved: {output_file}")
+        elif not metadata['files']:
             print("  ❌ No valid DataFrames to merge")
-            metadata['merged_df'] = pd.DataFrame()
         
         return metadata
     
@@ -279,17 +479,22 @@ class CSVMerger:
             
             print(f"\nFound {len(class_folders)} class(es): {[f.name for f in class_folders]}")
             
-            # Process each class
+            # Process the classes in parallel, one worker process per class
+            class_folders = sorted(class_folders)
+            max_workers = min(len(class_folders), os.cpu_count() or 1)
+            
             all_metadata = []
-            for class_folder in sorted(class_folders):
-                metadata = self.process_class(class_folder, output_dir)
-                all_metadata.append(metadata)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(_process_class_worker, self.root_path, class_folder, output_dir)
+                    for class_folder in class_folders
+                ]
                 
-                # Save merged CSV in the class-specific output folder
-                if not metadata['merged_df'].empty and metadata['output_folder']:
-                    output_file = metadata['output_folder'] / f"{metadata['class']}_merged.csv"
-                    metadata['merged_df'].to_csv(output_file, index=False)
-                    print(f"  💾 Saved: {output_file}")
+                # Collect results in class order so the log reads like a serial run
+                for future in futures:
+                    metadata, output = future.result()
+                    print(output, end='')
+                    all_metadata.append(metadata)
             
             # Print summary
             self.print_summary(all_metadata)
@@ -328,4 +533,26 @@ class CSVMerger:
                     total_input_rows += file_info['rows']
                 
                 print(f"   Input rows total: {total_input_rows:,}")
-                print(f"   Output rows: {meta['total_rows']:,}")
\ No newline at end of file
+                print(f"   Output rows: {meta['total_rows']:,}")
+
+
+def _process_class_worker(root_path: Path, class_folder: Path,
+                          output_base_dir: Path) -> Tuple[Dict, str]:
+    """
+    Process a single class in a worker process.
+    
+    Output printed while processing is captured and returned, so the parent
+    process can replay it in order (and into its log file).
+    
+    Args:
+        root_path: Path to the root directory containing class folders
+        class_folder: Path to the class folder
+        output_base_dir: Base output directory
+        
+    Returns:
+        Tuple of (metadata, captured output)
+    """
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        metadata = CSVMerger(root_path).process_class(class_folder, output_base_dir)
+    return metadata, buffer.getvalue()
@@ -3,12 +3,35 @@ Utility functions for CSV merging.
 This module contains helpers for file operations and text processing.
 """
 
+import os
 import re
+import tempfile
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from natsort import natsorted
 
 
+def _default_file_mode() -> int:
+    """Return the mode new files normally get: 0o666 minus the umask."""
+    # The umask can only be read by setting it, so put it straight back
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Read once at import time, before any worker threads start
+DEFAULT_FILE_MODE = _default_file_mode()
+
+
+# Pattern for X/Y/Z axis columns, matched against the original column name.
+# The axis letter must end the name and start a token of its own: after a
+# non-letter ("X", "Acc X", "gyro_y") or as a capital after a lowercase
+# letter ("AccX", "magZ"). "Index", "Z-score" and "Sensor Type" don't match
+COLUMN_PATTERN = re.compile(
+    r'^(?P<prefix>.*?)(?P<axis>(?<![A-Za-z])[xyzXYZ]|(?<=[a-z])[XYZ])\s*$'
+)
+
+
 def extract_ex_number(filename: str) -> Optional[int]:
     """
     Extract the exercise number from a filename.
@@ -44,8 +67,29 @@ def natural_sort_files(files: List[Path]) -> List[Path]:
     Returns:
         Sorted list of Path objects
     """
-    def sort_key(file_path: Path) -> tuple:
-        ex_num = extract_ex_number(file_path.name)
+    return [file_path for file_path, _ in sort_files_with_ex_numbers(files)]
+
+
+def sort_files_with_ex_numbers(files: List[Path]) -> List[Tuple[Path, Optional[int]]]:
+    """
+    Sort files naturally by their Ex number, keeping the numbers.
+    
+    Same order as natural_sort_files, but each Ex number is extracted
+    once and returned alongside its file, so callers don't need to
+    parse the filename again.
+    
+    Example:
+        [Path("a Ex10.csv"), Path("a Ex2.csv")] ->
+        [(Path("a Ex2.csv"), 2), (Path("a Ex10.csv"), 10)]
+    
+    Args:
+        files: List of Path objects to sort
+        
+    Returns:
+        Sorted list of (Path, Ex number or None) tuples
+    """
+    def sort_key(item: Tuple[Path, Optional[int]]) -> tuple:
+        file_path, ex_num = item
         # Files with Ex numbers come first, sorted by number
         # Files without come last, sorted alphabetically
         if ex_num is not None:
@@ -53,7 +97,30 @@ def natural_sort_files(files: List[Path]) -> List[Path]:
         else:
             return (1, file_path.name.lower())
     
-    return sorted(files, key=sort_key)
+    numbered = [(file_path, extract_ex_number(file_path.name)) for file_path in files]
+    return sorted(numbered, key=sort_key)
+
+
+def make_temp_file(directory: Path, suffix: str = '.tmp') -> Path:
+    """
+    Create an empty temporary file to be written and then moved into place.
+    
+    The file is created next to its final destination so os.replace can
+    swap it in atomically. tempfile.mkstemp creates owner-only (0600)
+    files, so the usual permissions are restored; otherwise the final
+    file would keep 0600 after the replace.
+    
+    Args:
+        directory: Directory to create the file in
+        suffix: Suffix for the temporary file name
+        
+    Returns:
+        Path to the new, empty file
+    """
+    fd, name = tempfile.mkstemp(dir=directory, suffix=suffix)
+    os.close(fd)
+    os.chmod(name, DEFAULT_FILE_MODE)
+    return Path(name)
 
 
 def normalize_column_name(col_name: str) -> str:
@@ -93,4 +160,54 @@ def find_matching_column(target: str, available_columns: List[str]) -> Optional[
         if target_normalized in col_normalized:
             return col
     
-    return None
\ No newline at end of file
+    return None
+
+
+def classify_columns(available_columns: List[str]) -> Dict[str, List[str]]:
+    """
+    Identify the time and X/Y/Z columns, scanning each name once.
+    
+    A column containing "channel" (case-insensitive) is a time column.
+    Any other column is scanned once with COLUMN_PATTERN, which splits
+    it into a prefix and an axis letter. Axis columns only count when
+    their prefix has at least two of the three axes (e.g. "AccX" and
+    "AccY"), so a lone "Latitude Y" is not taken for sensor data.
+    Every matching column is returned, in the original order, so callers
+    can tell when a kind is ambiguous (e.g. "Acc X" and "Gyro X").
+    
+    Example:
+        ["Channel name", "Index", "X", "Y", "Z"] ->
+        {"time": ["Channel name"], "x": ["X"], "y": ["Y"], "z": ["Z"]}
+        
+        ["channel_x", "AccX", "AccY", "AccZ", "Z-score", "Latitude Y"] ->
+        {"time": ["channel_x"], "x": ["AccX"], "y": ["AccY"], "z": ["AccZ"]}
+    
+    Args:
+        available_columns: List of available column names
+        
+    Returns:
+        Dictionary mapping "time", "x", "y" and "z" to the list of
+        matching column names (empty if none match)
+    """
+    columns = {'time': [], 'x': [], 'y': [], 'z': []}
+    candidates = []
+    prefix_axes = {}
+    
+    for col in available_columns:
+        if 'channel' in col.lower():
+            columns['time'].append(col)
+            continue
+        
+        match = COLUMN_PATTERN.match(col)
+        if match:
+            # "Acc X", "acc_x" and "AccX" share the prefix "acc"
+            prefix = match.group('prefix').rstrip(' _-.').lower()
+            axis = match.group('axis').lower()
+            candidates.append((col, prefix, axis))
+            prefix_axes.setdefault(prefix, set()).add(axis)
+    
+    for col, prefix, axis in candidates:
+        if len(prefix_axes[prefix]) >= 2:
+            columns[axis].append(col)
+    
+    return columns